@@ -1,24 +1,24 @@
 from typing import (List, TypeVar, Dict, Optional, Union,
-                    overload, cast, Set, NamedTuple, Iterable,
-                    Any)
+                    cast, Set, NamedTuple, Iterable,
+                    Any, Tuple)
 import re
 import sys
 import contextlib
+import copy
 import pickle
 import itertools
 import time
 import random
+import warnings
 from pathlib import Path
 
 import torch
 from torch import optim
 from torch import nn
 import torch.nn.modules.loss as loss
-import torch.utils.data as data
 import torch.nn.functional as F
 import torch.optim.lr_scheduler as scheduler
-from torch.nn.utils.rnn import pack_padded_sequence, PackedSequence
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, PackedSequence
 from torch.utils.tensorboard import SummaryWriter
 
 from tqdm import tqdm
@@ -50,7 +50,9 @@ def silent():
 
 with silent():
     use_cuda = torch.cuda.is_available()
-cuda_device = "cuda:0"
+# Encoding terms for use, rather than for training, is done in half
+# precision on the GPU.
+inference_dtype = torch.float16 if use_cuda else torch.float32
 PAD_token = 2
 EOS_token = 1
 SOS_token = 0
@@ -66,18 +68,17 @@ class CoqContextVectorizer:
     def obligation_to_vector(self, ob: Obligation) -> torch.FloatTensor:
         selected_hyps = ob.hypotheses[:3]
         selected_hyps += [":"] * (3 - len(selected_hyps))
-        encoded_goal: torch.Tensor = self.term_encoder.term_to_vector(ob.goal)
-        encoded_hyps: List[torch.Tensor] = \
-          [self.term_encoder.term_to_vector(get_hyp_type(hyp))
-           for hyp in selected_hyps]
-        return cast(torch.FloatTensor, torch.cat([encoded_goal] + encoded_hyps, dim=0))
+        encoded_terms = self.term_encoder.terms_to_vectors(
+          [ob.goal] + [get_hyp_type(hyp) for hyp in selected_hyps])
+        return cast(torch.FloatTensor, torch.cat(list(encoded_terms), dim=0))
 
 
 class CoqTermRNNVectorizer:
     symbol_mapping: Optional[Dict[str, int]]
     token_vocab: Optional[List[str]]
-    model: Optional['EncoderRNN']
+    _model: Optional['EncoderRNN']
     _decoder: Optional['DecoderRNN']
+    _inference_model: Optional[nn.Module]
     max_term_length: Optional[int]
     epochs_trained: int
     def __init__(self) -> None:
@@ -88,6 +89,28 @@ class CoqTermRNNVectorizer:
         self.max_term_length = None
         self.epochs_trained = 0
         pass
+    @property
+    def model(self) -> Optional['EncoderRNN']:
+        return self._model
+    @model.setter
+    def model(self, model: Optional['EncoderRNN']) -> None:
+        # The inference copy is a snapshot of the model's weights, so it has
+        # to be rebuilt from whatever model is set.
+        self._model = model
+        self._inference_model = None
+    def __getstate__(self) -> Dict[str, Any]:
+        # The scripted inference copy can't be pickled; it's rebuilt on demand.
+        state = dict(self.__dict__)
+        state["_inference_model"] = None
+        return state
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        # Vectorizers pickled before model became a property carry it as a
+        # plain "model" entry.
+        state = dict(state)
+        if "model" in state:
+            state["_model"] = state.pop("model")
+        self.__dict__.update(state)
+        self._inference_model = None
     def load_weights(self, model_path: Union[Path, str]) -> None:
         if isinstance(model_path, str):
             model_path = Path(model_path)
@@ -110,12 +133,10 @@ class CoqTermRNNVectorizer:
               allow_non_cuda: bool = False, verbosity: int = 0) -> Iterable[float]:
         assert use_cuda or allow_non_cuda, "Cannot train on non-cuda device unless passed allow_non_cuda"
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        token_set: Set[str] = set()
-        max_length_so_far = 0
-        for term in tqdm(terms, desc="Getting symbols", disable=verbosity < 1):
-            for symbol in get_symbols(term):
-                token_set.add(symbol)
-            max_length_so_far = max(len(get_symbols(term)), max_length_so_far)
+        tokenized = [get_symbols(term) for term in
+                     tqdm(terms, desc="Getting symbols", disable=verbosity < 1)]
+        token_set: Set[str] = set().union(*tokenized)
+        max_length_so_far = max(map(len, tokenized), default=0)
 
         self.token_vocab = list(token_set)
         self.symbol_mapping = {}
@@ -126,10 +147,7 @@ class CoqTermRNNVectorizer:
         else:
             self.max_term_length = max_length_so_far
 
-        term_tensor = torch.LongTensor([self.term_to_seq(term)
-            for term in tqdm(terms, desc="Tokenizing and normalizing", disable=verbosity < 1)])
-        term_lengths = torch.LongTensor([min(self.term_seq_length(term)+1, self.max_term_length)
-            for term in tqdm(terms, desc="Counting lengths", disable=verbosity < 1)])
+        term_tensor, term_lengths = self.symbol_lists_to_tensors(tokenized)
         yield from self.train_with_tensors(term_tensor, term_lengths, hidden_size, learning_rate, n_epochs,
                                            batch_size, print_every, gamma, force_max_length, epoch_step,
                                            num_layers, momentum, teacher_forcing_ratio, allow_non_cuda, verbosity)
@@ -148,34 +166,59 @@ class CoqTermRNNVectorizer:
         indices = list(range(dataset_size))
         np.random.shuffle(indices)
         split = int((dataset_size * split_ratio) / batch_size) * batch_size
-        train_indices, val_indices = indices[split:], indices[:split]
+        train_indices, val_indices = torch.LongTensor(indices[split:]), torch.LongTensor(indices[:split])
         valid_batch_size = max(batch_size // 2, 1)
-        train_sampler = SubsetRandomSampler(train_indices)
-        valid_sampler = SubsetRandomSampler(val_indices)
         num_batches = int((dataset_size - split) / batch_size)
         num_batches_valid = int(split / valid_batch_size)
 
         train_dataset_size = num_batches * batch_size
 
-        valid_data_batches = data.DataLoader(data.TensorDataset(term_tensor, term_lengths),
-                                             batch_size=valid_batch_size, num_workers=0,
-                                             sampler=valid_sampler, pin_memory=True, drop_last=True)
-        data_batches = data.DataLoader(data.TensorDataset(term_tensor, term_lengths),
-                                       batch_size=batch_size, num_workers=0,
-                                       sampler=train_sampler, pin_memory=True, drop_last=True)
+        # The whole corpus of token ids fits on the device, stored time-major
+        # as (seq_len, num_terms), so a batch is gathered there directly.
+        # The lengths stay on the CPU, where pack_padded_sequence wants them.
+        device_terms = term_tensor.t().contiguous().to(self.device)
 
-        encoder = maybe_cuda(EncoderRNN(len(self.token_vocab)+3, hidden_size, num_layers).to(self.device))
+        encoder = EncoderRNN(len(self.token_vocab)+3, hidden_size, num_layers).to(self.device)
         self.model = encoder
-        decoder = maybe_cuda(DecoderRNN(hidden_size, len(self.token_vocab)+3, num_layers).to(self.device))
+        decoder = DecoderRNN(hidden_size, len(self.token_vocab)+3, num_layers).to(self.device)
         self._decoder = decoder
-        optimizer = optim.SGD(itertools.chain(encoder.parameters(), decoder.parameters()),
-                              lr=learning_rate, momentum=momentum)
+        # Both sides of the autoencoder use the same vocabulary, so they share
+        # one embedding matrix, which is also the decoder's output projection.
+        decoder.embedding.weight = encoder.embedding.weight
+        decoder.out.weight = encoder.embedding.weight
+        # The compiled wrappers share parameters with encoder and decoder,
+        # which stay plain modules so that save_weights can pickle them.
+        train_encoder = maybe_compile(encoder)
+        train_decoder = maybe_compile(decoder)
+        # Module.parameters() yields the shared embedding only once
+        optimizer = optim.SGD(nn.ModuleList([encoder, decoder]).parameters(),
+                              lr=learning_rate, momentum=momentum, foreach=True)
         adjuster = scheduler.StepLR(optimizer, epoch_step,
                                     gamma=gamma)
 
-        criterion = nn.NLLLoss(ignore_index=PAD_token)
+        criterion = nn.CrossEntropyLoss(ignore_index=PAD_token)
+        # bf16 needs no loss scaling; older GPUs fall back to fp16 with a
+        # GradScaler. On the CPU both are disabled and training stays fp32.
+        use_amp = self.device.type == "cuda"
+        # Only Ampere and later have native bf16; is_bf16_supported() also
+        # counts emulated bf16 on older cards.
+        amp_dtype = torch.bfloat16 if use_amp and torch.cuda.get_device_capability()[0] >= 8 \
+          else torch.float16
+        scaler = make_grad_scaler(enabled=use_amp and amp_dtype == torch.float16)
         training_start=time.time()
         writer = SummaryWriter()
+        def write_batch_scalars(last_step: int, losses: List[torch.Tensor],
+                                accuracies: List[torch.Tensor]) -> None:
+            # One device sync for every batch since the last write
+            batch_losses, batch_accuracies = torch.stack([torch.stack(losses),
+                                                          torch.stack(accuracies)]).tolist()
+            first_step = last_step - len(losses) + 1
+            for step, (batch_loss, batch_accuracy) in enumerate(zip(batch_losses, batch_accuracies),
+                                                                start=first_step):
+                writer.add_scalar("Batch loss/train", batch_loss, step)
+                writer.add_scalar("Batch accuracy/train", batch_accuracy, step)
+            losses.clear()
+            accuracies.clear()
         if verbosity >= 1:
             print("Training")
         for pre_epoch in range(self.epochs_trained):
@@ -183,21 +226,31 @@ class CoqTermRNNVectorizer:
         for epoch in range(self.epochs_trained, n_epochs):
             if verbosity >= 1:
                 print("Epoch {} (learning rate {:.6f})".format(epoch, optimizer.param_groups[0]['lr']))
-            epoch_loss = 0.
+            # Kept on the device, so that only logging and printing have
+            # to wait for the GPU.
+            epoch_loss = torch.zeros((), device=self.device)
+            pending_losses: List[torch.Tensor] = []
+            pending_accuracies: List[torch.Tensor] = []
             epoch_tf_ratio = teacher_forcing_ratio * (1 - (epoch / (n_epochs - 1)))
-            for batch_num, (term_batch, lengths_batch) in enumerate(data_batches, start=1):
-                optimizer.zero_grad()
-                lengths_sorted, sorted_idx = lengths_batch.sort(descending=True)
-                padded_term_batch = pack_padded_sequence(term_batch[sorted_idx], lengths_sorted, batch_first=True)
-                loss, accuracy = autoencoderBatchIter(encoder, decoder, maybe_cuda(padded_term_batch),
-                                                      maybe_cuda(term_batch[sorted_idx]), maybe_cuda(lengths_sorted),
-                                                      criterion, epoch_tf_ratio)
-                writer.add_scalar("Batch loss/train", loss, epoch * num_batches + batch_num)
-                writer.add_scalar("Batch accuracy/train", accuracy, epoch * num_batches + batch_num)
-                loss.backward()
-                optimizer.step()
-                epoch_loss += loss.item()
+            epoch_order = train_indices[torch.randperm(len(train_indices))]
+            for batch_num, batch_start in enumerate(range(0, train_dataset_size, batch_size), start=1):
+                optimizer.zero_grad(set_to_none=True)
+                term_batch, lengths_sorted = time_major_batch(device_terms, term_lengths,
+                                                              epoch_order[batch_start:batch_start+batch_size])
+                padded_term_batch = pack_padded_sequence(term_batch, lengths_sorted)
+                with torch.autocast(device_type=self.device.type, dtype=amp_dtype, enabled=use_amp):
+                    loss, accuracy = autoencoderBatchIter(train_encoder, train_decoder, padded_term_batch,
+                                                          term_batch, lengths_sorted.to(self.device, non_blocking=True),
+                                                          criterion, epoch_tf_ratio)
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+                epoch_loss += loss.detach()
+                pending_losses.append(loss.detach().float())
+                pending_accuracies.append(accuracy.detach().float())
                 if batch_num % print_every == 0:
+                    write_batch_scalars(epoch * num_batches + batch_num,
+                                        pending_losses, pending_accuracies)
                     items_processed = batch_num * batch_size + \
                       epoch * train_dataset_size
                     progress = items_processed / \
@@ -206,16 +259,21 @@ class CoqTermRNNVectorizer:
                         print("{} ({:7} {:5.2f}%) {:.4f}"
                               .format(timeSince(training_start, progress),
                                       items_processed, progress * 100,
-                                      epoch_loss / batch_num))
-            with torch.no_grad():
-                valid_accuracy = maybe_cuda(torch.FloatTensor([0.]))
-                valid_loss = maybe_cuda(torch.FloatTensor([0.]))
-                for idx, (valid_data_batch,valid_lengths_batch) in enumerate(valid_data_batches):
-                    lengths_sorted, sorted_idx = valid_lengths_batch.sort(descending=True)
-                    valid_padded_batch = pack_padded_sequence(valid_data_batch[sorted_idx], lengths_sorted, batch_first=True)
-                    batch_loss, batch_accuracy = autoencoderBatchIter(encoder, decoder, maybe_cuda(valid_padded_batch),
-                                                                      maybe_cuda(valid_data_batch[sorted_idx]), lengths_sorted,
-                                                                      criterion, 0., verbosity=verbosity if idx == len(valid_data_batches)-1 else 0, model=self)
+                                      epoch_loss.item() / batch_num))
+            if pending_losses:
+                write_batch_scalars(epoch * num_batches + batch_num,
+                                    pending_losses, pending_accuracies)
+            with torch.no_grad(), torch.autocast(device_type=self.device.type, dtype=amp_dtype, enabled=use_amp):
+                valid_accuracy = torch.zeros((), device=self.device)
+                valid_loss = torch.zeros((), device=self.device)
+                for idx in range(num_batches_valid):
+                    valid_data_batch, lengths_sorted = time_major_batch(
+                      device_terms, term_lengths,
+                      val_indices[idx*valid_batch_size:(idx+1)*valid_batch_size])
+                    valid_padded_batch = pack_padded_sequence(valid_data_batch, lengths_sorted)
+                    batch_loss, batch_accuracy = autoencoderBatchIter(train_encoder, train_decoder, valid_padded_batch,
+                                                                      valid_data_batch, lengths_sorted.to(self.device, non_blocking=True),
+                                                                      criterion, 0., verbosity=verbosity if idx == num_batches_valid-1 else 0, model=self)
                     valid_loss = cast(torch.FloatTensor, valid_loss + batch_loss)
                     valid_accuracy = cast(torch.FloatTensor, valid_accuracy + batch_accuracy)
             writer.add_scalar("Loss/valid", valid_loss / num_batches_valid,
@@ -227,17 +285,46 @@ class CoqTermRNNVectorizer:
                       f"Validation accuracy: {valid_accuracy.item() * 100 / num_batches_valid:.2f}%")
 
             adjuster.step()
+            # Also drops the inference copy, so that encoding between epochs
+            # uses this epoch's weights
             self.model = encoder
             self._decoder = decoder
             yield valid_loss.item() / num_batches_valid
             pass
         pass
     def term_to_seq(self, term_text: str) -> List[int]:
+        return self.symbols_to_seq(get_symbols(term_text))
+    def symbols_to_seq(self, symbols: List[str]) -> List[int]:
         return normalize_sentence_length([self.symbol_mapping[symb]
-                                          for symb in get_symbols(term_text)
+                                          for symb in symbols
                                           if symb in self.symbol_mapping][:self.max_term_length-1] + [EOS_token],
                                          self.max_term_length,
                                          PAD_token)
+    def symbol_lists_to_tensors(self, symbol_lists: List[List[str]]) \
+          -> Tuple[torch.LongTensor, torch.LongTensor]:
+        assert self.symbol_mapping
+        assert self.max_term_length
+        num_terms = len(symbol_lists)
+        counts = np.fromiter(map(len, symbol_lists), dtype=np.int64, count=num_terms)
+        # One dict lookup per token for the whole corpus, with unknown
+        # symbols mapped to -1 and then dropped.
+        ids = np.fromiter(map(self.symbol_mapping.get,
+                              itertools.chain.from_iterable(symbol_lists),
+                              itertools.repeat(-1)),
+                          dtype=np.int64, count=int(counts.sum()))
+        rows = np.repeat(np.arange(num_terms), counts)
+        known = ids >= 0
+        ids, rows = ids[known], rows[known]
+        known_counts = np.bincount(rows, minlength=num_terms)
+        cols = np.arange(len(ids)) - np.repeat(np.cumsum(known_counts) - known_counts, known_counts)
+        in_bounds = cols < self.max_term_length - 1
+        seqs = np.full((num_terms, self.max_term_length), PAD_token, dtype=np.int64)
+        seqs[rows[in_bounds], cols[in_bounds]] = ids[in_bounds]
+        lengths = np.minimum(known_counts, self.max_term_length - 1)
+        seqs[np.arange(num_terms), lengths] = EOS_token
+        lengths += 1
+        return cast(torch.LongTensor, torch.from_numpy(seqs)), \
+          cast(torch.LongTensor, torch.from_numpy(lengths))
     def term_seq_length(self, term_text: str) -> int:
         return len([True for symb in get_symbols(term_text) if symb in self.symbol_mapping])
     def seq_to_symbol_list(self, seq: List[int]) -> List[str]:
@@ -254,19 +341,76 @@ class CoqTermRNNVectorizer:
         return " ".join(self.seq_to_symbol_list(seq))
     def term_to_vector(self, term_text: str) -> torch.FloatTensor:
         return self.seq_to_vector(self.term_to_seq(term_text))
+    def terms_to_vectors(self, terms: List[str], batch_size: int = 256) -> torch.FloatTensor:
+        assert self.symbol_mapping, "No loaded weights!"
+        assert self.model, "No loaded weights!"
+        device = "cuda" if use_cuda else "cpu"
+        term_tensor, term_lengths = self.symbol_lists_to_tensors([get_symbols(term) for term in terms])
+        model = self._get_inference_model()
+        vectors = torch.empty(len(terms), self.model.num_layers, self.model.hidden_size)
+        # On the GPU, each chunk's vectors are copied asynchronously into one
+        # of two pinned staging buffers, and only moved into vectors once
+        # that copy has finished, so copying overlaps with encoding the next
+        # chunk without pinning the whole result. Input chunks are pinned
+        # the same way so that their upload doesn't block either.
+        staging = [torch.empty(min(batch_size, len(terms)), self.model.num_layers,
+                               self.model.hidden_size, pin_memory=True)
+                   for _ in range(2)] if use_cuda else []
+        in_flight: List[Optional[Tuple[torch.cuda.Event, int, int]]] = [None, None]
+        def unstage(slot: int) -> None:
+            if in_flight[slot] is not None:
+                copied, start, count = in_flight[slot]
+                copied.synchronize()
+                vectors[start:start+count].copy_(staging[slot][:count])
+                in_flight[slot] = None
+        with torch.inference_mode():
+            for chunk_num, start in enumerate(range(0, len(terms), batch_size)):
+                chunk_lengths = term_lengths[start:start+batch_size]
+                chunk = term_tensor[start:start+batch_size, :int(chunk_lengths.max())].t()
+                if use_cuda:
+                    chunk = chunk.contiguous().pin_memory().to(device, non_blocking=True)
+                packed = pack_padded_sequence(chunk, chunk_lengths, enforce_sorted=False)
+                hidden = self.model.initHidden(len(chunk_lengths), device).to(inference_dtype)
+                cell = self.model.initCell(len(chunk_lengths), device).to(inference_dtype)
+                _, hidden, cell = model(packed, hidden, cell)
+                if use_cuda:
+                    slot = chunk_num % 2
+                    unstage(slot)
+                    staging[slot][:len(chunk_lengths)].copy_(hidden.transpose(0, 1), non_blocking=True)
+                    copied = torch.cuda.Event()
+                    copied.record()
+                    in_flight[slot] = (copied, start, len(chunk_lengths))
+                else:
+                    vectors[start:start+len(chunk_lengths)].copy_(hidden.transpose(0, 1))
+            for slot in range(2):
+                unstage(slot)
+        return cast(torch.FloatTensor, vectors)
 
     def seq_to_vector(self, term_seq: List[int]) -> torch.FloatTensor:
         assert self.symbol_mapping, "No loaded weights!"
         assert self.model, "No loaded weights!"
+        device = "cuda" if use_cuda else "cpu"
         input_length = len([t for t in term_seq if t != PAD_token])
-        term_tensor = pack_padded_sequence(maybe_cuda(torch.LongTensor([term_seq])),
-                                           torch.LongTensor([input_length]), batch_first=True)
-        with torch.no_grad():
-            device = "cuda" if use_cuda else "cpu"
-            hidden = self.model.initHidden(1, device)
-            cell = self.model.initCell(1, device)
-            _, hidden, cell = self.model(term_tensor, hidden, cell)
-        return hidden.squeeze(1).cpu()
+        term_tensor = pack_padded_sequence(torch.as_tensor(term_seq, device=device).unsqueeze(1),
+                                           torch.LongTensor([input_length]))
+        with torch.inference_mode():
+            hidden = self.model.initHidden(1, device).to(inference_dtype)
+            cell = self.model.initCell(1, device).to(inference_dtype)
+            _, hidden, cell = self._get_inference_model()(term_tensor, hidden, cell)
+        # Copy out of inference mode, so callers can feed the vector to
+        # models that are being trained.
+        return hidden.squeeze(1).to("cpu", dtype=torch.float32, copy=True)
+    def _get_inference_model(self) -> nn.Module:
+        assert self.model, "No loaded weights!"
+        if self._inference_model is None:
+            # A scripted and frozen copy, so that self.model stays a plain
+            # fp32 module for training and saving.
+            model = copy.deepcopy(self.model).to(inference_dtype).eval()
+            with warnings.catch_warnings():
+                # Newer torch releases flag TorchScript as deprecated on every call
+                warnings.filterwarnings("ignore", category=FutureWarning, module=r"torch\.jit")
+                self._inference_model = torch.jit.optimize_for_inference(torch.jit.script(model))
+        return self._inference_model
     def vector_to_term(self, term_vec: torch.FloatTensor) -> str:
         return self.output_seq_to_term(self.vector_to_seq(term_vec))
     def vector_to_seq(self, term_vec: torch.FloatTensor) -> List[int]:
@@ -278,7 +422,7 @@ class CoqTermRNNVectorizer:
         assert term_vec.size() == torch.Size([self.model.num_layers, self.model.hidden_size]), f"Wrong dimensions for input {term_vec.size()}"
         device = "cuda" if use_cuda else "cpu"
         self._decoder.to(device)
-        with torch.no_grad():
+        with torch.inference_mode():
             decoder_hidden = term_vec.unsqueeze(1).to(device)
             decoder_input = torch.tensor([[SOS_token]], device=device)
             decoder_cell = self._decoder.initCell(1, device)
@@ -286,7 +430,7 @@ class CoqTermRNNVectorizer:
             for di in range(self.max_term_length):
                 decoder_output, decoder_hidden, decoder_cell = self._decoder(decoder_input, decoder_hidden, decoder_cell)
                 topv, topi = decoder_output.topk(1)
-                next_char = topi.view(1).detach()
+                next_char = topi.view(1, 1).detach()
                 output_seq.append(next_char.item())
                 decoder_input = next_char
         return output_seq
@@ -301,19 +445,20 @@ class EncoderRNN(nn.Module):
         self.lstm = nn.LSTM(hidden_size, hidden_size, num_layers=num_layers)
         self.num_layers = num_layers
 
-    def forward(self, input: torch.LongTensor, hidden: torch.FloatTensor,
-                cell: torch.FloatTensor):
-        batch_size = input.batch_sizes[0]
-        max_input_length = len(input.batch_sizes)
-        embedded = PackedSequence(F.relu(self.embedding(input.data)), input.batch_sizes)
+    def forward(self, input: PackedSequence, hidden: torch.Tensor,
+                cell: torch.Tensor):
+        # The whole packed batch goes through a single nn.LSTM call, so
+        # cuDNN runs every timestep of every layer in one fused kernel.
+        embedded = PackedSequence(F.relu(self.embedding(input.data)), input.batch_sizes,
+                                  input.sorted_indices, input.unsorted_indices)
         output, (hidden, cell) = self.lstm(embedded, (hidden,cell))
         return output, hidden, cell
 
     def initHidden(self,batch_size: int, device: str):
-        return maybe_cuda(torch.zeros(self.num_layers, batch_size, self.hidden_size, device=device))
+        return torch.zeros(self.num_layers, batch_size, self.hidden_size, device=device)
 
     def initCell(self,batch_size: int, device: str):
-        return maybe_cuda(torch.zeros(self.num_layers, batch_size, self.hidden_size, device=device))
+        return torch.zeros(self.num_layers, batch_size, self.hidden_size, device=device)
 
 class DecoderRNN(nn.Module):
     def __init__(self, hidden_size: int, output_size: int, num_layers: int = 1) -> None:
@@ -322,16 +467,25 @@ class DecoderRNN(nn.Module):
         self.embedding = nn.Embedding(output_size, hidden_size)
         self.lstm = nn.LSTM(hidden_size, hidden_size, num_layers=num_layers)
         self.out = nn.Linear(hidden_size, output_size)
-        self.softmax = nn.LogSoftmax(dim=2)
         self.num_layers = num_layers
         self.output_size = output_size
 
-    def forward(self, input, hidden, cell):
-        batch_size = input.size(0)
-        embedded = self.embedding(input).view(1, batch_size, self.hidden_size)
+    def forward(self, input: Union[torch.LongTensor, PackedSequence], hidden: torch.FloatTensor,
+                cell: torch.FloatTensor):
+        if isinstance(input, PackedSequence):
+            # Only the real timesteps go through the LSTM and the output
+            # projection; the logits come back packed the same way.
+            embedded = PackedSequence(F.relu(self.embedding(input.data)), input.batch_sizes,
+                                      input.sorted_indices, input.unsorted_indices)
+            output, (hidden, cell) = self.lstm(embedded, (hidden, cell))
+            return PackedSequence(self.out(output.data), output.batch_sizes,
+                                  output.sorted_indices, output.unsorted_indices), hidden, cell
+        # input is (seq_len, batch); a single step is just seq_len == 1
+        embedded = self.embedding(input)
         output, (hidden, cell) = self.lstm(F.relu(embedded), (hidden, cell))
-        token_dist = self.softmax(self.out(output))
-        return token_dist, hidden, cell
+        # Raw logits; the loss applies log-softmax itself
+        logits = self.out(output)
+        return logits, hidden, cell
 
     def initHidden(self,batch_size: int, device: str):
         return torch.zeros(self.num_layers, batch_size, self.hidden_size, device=device)
@@ -339,52 +493,76 @@ class DecoderRNN(nn.Module):
     def initCell(self,batch_size: int, device: str):
         return torch.zeros(self.num_layers, batch_size, self.hidden_size, device=device)
 
+def reversed_targets(output: torch.LongTensor, lengths: torch.LongTensor,
+                     target_length: int) -> torch.LongTensor:
+    # Builds the (target_length, batch) decoder targets from the
+    # (seq_len, batch) input: each term's tokens in reverse order, then EOS,
+    # then PAD.
+    steps = torch.arange(target_length, device=output.device).unsqueeze(1)
+    lengths = lengths.to(output.device).unsqueeze(0)
+    reversed_terms = output.gather(0, (lengths - (steps + 2)).clamp(min=0))
+    eos_or_pad = torch.where(steps == lengths - 1,
+                             torch.full_like(reversed_terms, EOS_token),
+                             torch.full_like(reversed_terms, PAD_token))
+    return torch.where(steps < lengths - 1, reversed_terms, eos_or_pad)
+
 def autoencoderBatchIter(encoder: EncoderRNN, decoder: DecoderRNN, data: torch.LongTensor, output: torch.LongTensor, lengths: torch.LongTensor,
-                         criterion: loss._Loss, teacher_forcing_ratio: float, verbosity:int = 0, model: Optional[CoqTermRNNVectorizer] = None) -> torch.FloatTensor:
-    batch_size = data.batch_sizes[0]
+                         criterion: loss._Loss, teacher_forcing_ratio: float, verbosity:int = 0,
+                         model: Optional[CoqTermRNNVectorizer] = None) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+    batch_size = int(data.batch_sizes[0])
     input_length = len(data.batch_sizes)
     target_length = input_length
     device = "cuda" if use_cuda else "cpu"
 
-    loss: torch.FloatTensor = maybe_cuda(torch.tensor([0.]))
-    accuracy_sum = 0.
     hidden = encoder.initHidden(batch_size, device)
     cell = encoder.initCell(batch_size, device)
     _, hidden, cell = encoder(data, hidden, cell)
-    decoder_hidden = hidden.clone()
-    decoder_input = torch.tensor([[SOS_token]]*batch_size, device=device)
+    targets = reversed_targets(output, lengths, target_length)
     decoder_cell = decoder.initCell(batch_size, device)
-    decoder_results = []
-    target_input = torch.tensor([[SOS_token]]*batch_size, device=device)
-    for di in range(target_length):
-        # target = output[:,target_length-(di+1)]
-        if random.random() < teacher_forcing_ratio:
-             decoder_output, decoder_hidden, decoder_cell = decoder(target_input, decoder_hidden, decoder_cell)
-        else:
-             decoder_output, decoder_hidden, decoder_cell = decoder(decoder_input, decoder_hidden, decoder_cell)
-        target = maybe_cuda(torch.LongTensor([output[i, lengths[i]-(di+2)] if di < lengths[i]-1 else EOS_token if di == lengths[i]-1 else PAD_token for i in range(batch_size)]))
-        topv, topi = decoder_output.topk(1)
-        decoder_input = topi.view(batch_size).detach()
-        target_input = target
-
-        item_loss = criterion(decoder_output.view(batch_size, decoder.output_size), target)
-        loss = cast(torch.FloatTensor, loss + item_loss)
-        decoder_results.append(decoder_input)
-        accuracy_sum += torch.sum((decoder_input == target) * (target != PAD_token).int().float()).item()
-    accuracy_denominator = torch.sum((output != PAD_token).int().float()).item()
+    sos_row = torch.full((1, batch_size), SOS_token, dtype=torch.long, device=device)
+    if random.random() < teacher_forcing_ratio:
+        # With teacher forcing the decoder inputs are known up front, so the
+        # whole target sequence goes through the LSTM in one call. Each term
+        # decodes for as many steps as it was encoded for, so the decoder
+        # sequences pack with the encoder's lengths and term order.
+        packed_lengths = (data.batch_sizes.unsqueeze(1) > torch.arange(batch_size)).sum(dim=0)
+        sorted_targets = targets if data.sorted_indices is None else targets[:, data.sorted_indices]
+        packed_inputs = pack_padded_sequence(torch.cat([sos_row, sorted_targets[:-1]], dim=0), packed_lengths)
+        decoder_inputs = PackedSequence(packed_inputs.data, packed_inputs.batch_sizes,
+                                        data.sorted_indices, data.unsorted_indices)
+        packed_output, _, _ = decoder(decoder_inputs, hidden, decoder_cell)
+        loss = criterion(packed_output.data, pack_padded_sequence(sorted_targets, packed_lengths).data)
+        decoder_results, _ = pad_packed_sequence(
+          PackedSequence(packed_output.data.argmax(dim=1), packed_output.batch_sizes,
+                         packed_output.sorted_indices, packed_output.unsorted_indices),
+          padding_value=PAD_token, total_length=target_length)
+    else:
+        decoder_input = sos_row
+        decoder_hidden = hidden
+        step_outputs = []
+        for di in range(target_length):
+            step_output, decoder_hidden, decoder_cell = decoder(decoder_input, decoder_hidden, decoder_cell)
+            decoder_input = step_output.argmax(dim=2).detach()
+            step_outputs.append(step_output)
+        decoder_output = torch.cat(step_outputs, dim=0)
+        loss = criterion(decoder_output.view(target_length * batch_size, decoder.output_size),
+                         targets.view(target_length * batch_size))
+        decoder_results = decoder_output.argmax(dim=2)
+    accuracy_sum = torch.sum((decoder_results == targets) & (targets != PAD_token))
+    accuracy_denominator = torch.sum(output != PAD_token)
     if verbosity > 1:
         for i in range(batch_size):
             encoded_state = hidden[:,i].tolist()
-            decoded_result = [decoder_results[j][i].item() for j in range(target_length)]
-            print(f"{model.input_seq_to_term(output[i])} -> {output[i].tolist()} -> {encoded_state} -> {decoded_result} -> {model.output_seq_to_term(decoded_result)}")
+            decoded_result = decoder_results[:, i].tolist()
+            print(f"{model.input_seq_to_term(output[:, i])} -> {output[:, i].tolist()} -> {encoded_state} -> {decoded_result} -> {model.output_seq_to_term(decoded_result)}")
     elif verbosity > 0:
         for i in range(min(batch_size, 4)):
             # target = maybe_cuda(torch.LongTensor([output[i, lengths[i]-(j+2)] if j < lengths[i]-1
             #                                       else EOS_token if j == lengths[i]-1 else PAD_token
             #                                       for j in range(target_length)]))
             # print(f"Target is {model.output_seq_to_term(target)} -> {target.tolist()}")
-            decoded_result = [decoder_results[j][i].item() for j in range(target_length)]
-            print(f"{model.input_seq_to_term(output[i])} [======>>\n{model.output_seq_to_term(decoded_result)}")
+            decoded_result = decoder_results[:, i].tolist()
+            print(f"{model.input_seq_to_term(output[:, i])} [======>>\n{model.output_seq_to_term(decoded_result)}")
             # sample_correct = torch.sum((maybe_cuda(torch.tensor(decoded_result)) == target) * (target != PAD_token).int().float()).item()
             # sample_denominator = torch.sum((target != PAD_token).int().float()).item()
             # print(f"Number of matching tokens: {torch.sum(maybe_cuda(torch.tensor(decoded_result)) == target)}")
@@ -392,7 +570,7 @@ def autoencoderBatchIter(encoder: EncoderRNN, decoder: DecoderRNN, data: torch.L
             # assert output[i, 0] not in [model.symbol_mapping[c] for c in [".", ")"]], f"Input term {output[i]} doesn't make any sense!"
         #print(f"Accuracy: {accuracy_sum} / {accuracy_denominator}")
 
-    return loss / target_length, accuracy_sum / accuracy_denominator
+    return loss, accuracy_sum.float() / accuracy_denominator
 
 def tune_termrnn_hyperparameters(terms: List[str], n_epochs: int,
                                  batch_size: int, print_every: int,
@@ -433,28 +611,37 @@ def tune_termrnn_hyperparameters(terms: List[str], n_epochs: int,
 symbols_regexp = (r',|(?::>)|(?::(?!=))|(?::=)|\)|\(|;|@\{|~|\+{1,2}|\*{1,2}|&&|\|\||'
                   r'(?<!\\)/(?!\\)|/\\|\\/|(?<![<*+-/|&])=(?!>)|%|(?<!<)-(?!>)|'
                   r'<-|->|<=|>=|<>|\^|\[|\]|(?<!\|)\}|\{(?!\|)|\.(?=$|\s+)')
+# Matches either a symbol, or a run of other non-whitespace characters
+# up to the next symbol, so tokens come out of a single findall pass.
+symbols_regex = re.compile(r'(?:' + symbols_regexp + r')|\S+?(?=' + symbols_regexp + r'|\s|$)')
 def get_symbols(string: str) -> List[str]:
-    return [word for word in re.sub(
-        r'(' + symbols_regexp + ')',
-        r' \1 ', string).split()
-            if word.strip() != '']
+    return symbols_regex.findall(string)
 
 T1 = TypeVar('T1', bound=nn.Module)
-T2 = TypeVar('T2', bound=torch.Tensor)
-@overload
-def maybe_cuda(component: T1) -> T1:
-    ...
-
-@overload
-def maybe_cuda(component: T2) -> T2:
-    ...
-
-def maybe_cuda(component):
-    if use_cuda:
-        return component.to(device=torch.device(cuda_device))
+def maybe_compile(component: T1) -> T1:
+    # Packed batches change shape from batch to batch, so this sticks to
+    # the default mode rather than CUDA-graph based "reduce-overhead".
+    if use_cuda and hasattr(torch, "compile"):
+        return cast(T1, torch.compile(component))
     else:
         return component
 
+def time_major_batch(terms: torch.LongTensor, lengths: torch.LongTensor,
+                     batch_idxs: torch.LongTensor) -> Tuple[torch.LongTensor, torch.LongTensor]:
+    # Gathers a (seq_len, batch) batch out of the (seq_len, num_terms)
+    # terms, sorted by decreasing length as pack_padded_sequence expects.
+    lengths_sorted, sorted_idx = lengths[batch_idxs].sort(descending=True)
+    term_batch = terms[:, batch_idxs[sorted_idx].to(terms.device, non_blocking=True)]
+    return cast(torch.LongTensor, term_batch), cast(torch.LongTensor, lengths_sorted)
+
+def make_grad_scaler(enabled: bool) -> Any:
+    # torch.amp.GradScaler only exists from torch 2.3 on, and the older
+    # torch.cuda.amp one warns there.
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda", enabled=enabled)
+    else:
+        return torch.cuda.amp.GradScaler(enabled=enabled)
+
 def normalize_sentence_length(sentence: List[int], target_length: int, fill_value: int) -> List[int]:
     if len(sentence) > target_length:
         return sentence[:target_length]
@@ -46,13 +46,14 @@ for lidx, line in enumerate(samples):
     if lidx < 5:
         display(line.strip())
         print(f"Accuracy of sample: {sample_correct * 100 / sample_predicted:.2f}% ({sample_correct} / {sample_predicted})")
-criterion = nn.NLLLoss(ignore_index=PAD_token)
+criterion = nn.CrossEntropyLoss(ignore_index=PAD_token)
 term_batch = torch.tensor(term_seqs)
 lengths_sorted, sorted_idxs = torch.tensor(term_lengths).sort(descending=True)
-packed_term_batch = pack_padded_sequence(term_batch[sorted_idxs], lengths_sorted, batch_first=True)
+term_batch = term_batch[sorted_idxs].t().contiguous()
+packed_term_batch = pack_padded_sequence(term_batch, lengths_sorted)
 test_loss, test_accuracy = autoencoderBatchIter(vectorizer.model, vectorizer._decoder,
                                                 packed_term_batch.to(device),
-                                                term_batch[sorted_idxs].to(device),
+                                                term_batch.to(device),
                                                 lengths_sorted.to(device),
                                                 criterion, 0.0, verbosity=1, model=vectorizer)
 print(f"Accuracy, the training way: {test_accuracy * 100:.2f}%")